@@ -1,12 +1,18 @@
 import os, sys
+import numpy as np
+import pandas as pd
 
 input_cov = sys.argv[1] # input .cov file generated by bedtools genomecov -d
 
 # 0-based positions with high entropy based on mbrown analysis
-POSITIONS = [1237, 3215, 8978, 11283, 14608, 17947, 18058, 18260, 23616, 25777, 28358]
-
-for line in open(input_cov):
-    name, pos1, cov = line.strip().split()
-    pos1, cov = int(pos1), int(cov)
-    if pos1-1 in POSITIONS: print(pos1, cov)
+POSITIONS = frozenset([1237, 3215, 8978, 11283, 14608, 17947, 18058, 18260, 23616, 25777, 28358])
 
+try:
+    df = pd.read_csv(input_cov, sep='\t', header=None, names=['chr', 'pos', 'cov'],
+                     dtype={'pos': np.int32, 'cov': np.int32}, engine='c')
+except pd.errors.EmptyDataError: # empty .cov file, nothing to report
+    sys.exit(0)
+sought = np.array(sorted(POSITIONS), dtype=np.int32)
+hits = df[np.isin(df['pos'].values-1, sought)]
+for r in hits.itertuples():
+    print(r.pos, r.cov)
@@ -3,18 +3,25 @@ __version__ = '8.5.0'
 #import pdb
 import os, sys
 from collections import Counter
+from functools import partial
 from csv import DictWriter
 from Bio import SeqIO
+import numpy as np
 import vcf
 
 VARIANT_FIELDS = ['Pos', 'Type', 'Length', 'Depth', 'AltCount']
 
-def make_seq_from_list(seqlist, start0, end1):
-    seq = ''
-    for i in range(start0, end1):
-        if i in seqlist:
-            seq += seqlist[i]
-    return seq
+def make_seq_from_list(bases, present, insertions, start0, end1):
+    buf = np.frombuffer(bases, dtype=np.uint8)
+    seq = []
+    # copy over the non-deleted bases in one slice between each insertion
+    for pos0 in sorted(insertions):
+        if start0 <= pos0 < end1 and present[pos0]:
+            seq.append(buf[start0:pos0+1][present[start0:pos0+1]].tobytes())
+            seq.append(insertions[pos0])
+            start0 = pos0 + 1
+    seq.append(buf[start0:end1][present[start0:end1]].tobytes())
+    return b''.join(seq)
 
 def get_alt_count_std(num_gt, x, name):
     if num_gt != len(x.data.AD):
@@ -53,6 +60,23 @@ def get_alt_count_pbaa(num_gt, x, name):
                 alt_count_dict[str(i)] += int(x.data.AD[i])
             return alt_count_dict
 
+def _cov_and_alt_from_counts(get_alt_count, num_gt, v, x, name):
+    # v is unused, it is only here so every GET_COV_AND_ALT function takes the same arguments
+    total_cov = x.data.DP
+    alt_index, alt_count = get_alt_count(num_gt, x, name).most_common()[0]
+    return total_cov, alt_index, alt_count
+
+def get_cov_and_alt_bcftools(num_gt, v, x, name):
+    ##INFO=<ID=DP4,Number=4,Type=Integer,Description="Number of high-quality ref-forward , ref-reverse, alt-forward and alt-reverse bases">
+    total_cov = v.INFO['DP']
+    alt_count = v.INFO['DP4'][2] + v.INFO['DP4'][3]
+    return total_cov, 1, alt_count
+
+# vcf_type --> function returning (total_cov, alt_index, alt_count), anything else is standard (ex: deepvariant)
+GET_COV_AND_ALT = {'pbaa': partial(_cov_and_alt_from_counts, get_alt_count_pbaa),
+                   'CLC': partial(_cov_and_alt_from_counts, get_alt_count_clc),
+                   'bcftools': get_cov_and_alt_bcftools}
+
 def genVCFcons(ref_fasta, depth_file, vcf_input, prefix, newid,
                min_coverage=4, min_alt_freq=0.5, min_qual=100,
                vcf_type=None):
@@ -72,20 +96,28 @@ def genVCFcons(ref_fasta, depth_file, vcf_input, prefix, newid,
 
     ref = next(SeqIO.parse(open(ref_fasta),'fasta'))
     refseq = str(ref.seq)
-    refseq = list(refseq)
 
     # NOTE: we are using samtools depth to get the per base coverage
-    depth_per_pos = {} # 0-based POS --> read depth
-    for line in open(depth_file):
-        chrom, pos1, count = line.strip().split()
-        depth_per_pos[int(pos1)-1] = int(count)
+    # depth file format: chrom, 1-based POS, read depth
+    depth_pos_cov = np.loadtxt(depth_file, usecols=(1,2), dtype=np.int32, ndmin=2)
+    depth = np.zeros(len(refseq), dtype=np.int32) # 0-based POS --> read depth
+    listed = np.zeros(len(refseq), dtype=bool) # positions in the depth file, all others are "N"
+    # ignore positions past the end of the reference (ex: depth file for a longer contig)
+    in_ref = depth_pos_cov[depth_pos_cov[:,0] <= len(refseq)]
+    depth[in_ref[:,0]-1] = in_ref[:,1]
+    listed[in_ref[:,0]-1] = True
 
-    newseqlist = dict(zip(range(len(refseq)), list(refseq)))
-    for pos0 in range(len(refseq)):
-        if pos0 not in depth_per_pos or depth_per_pos[pos0] < min_coverage: newseqlist[pos0] = 'N'
+    covered = listed & (depth >= min_coverage)
     # make sure begin/ends are "N"s
-    for pos0 in range(min(depth_per_pos)): newseqlist[pos0] = 'N'
-    for pos0 in range(max(depth_per_pos),len(refseq)): newseqlist[pos0] = 'N'
+    covered[:depth_pos_cov[:,0].min()-1] = False
+    covered[depth_pos_cov[:,0].max()-1:] = False
+
+    # consensus is the reference bases, plus a mask of bases that are not deleted,
+    # plus the (rare) inserted bases that follow a position
+    bases = bytearray(refseq.encode())
+    np.frombuffer(bases, dtype=np.uint8)[~covered] = ord('N')
+    present = np.ones(len(refseq), dtype=bool)
+    insertions = {} # 0-based POS --> inserted bases (bytes) after POS
 
     # now add in the variants
     tally_types = Counter() # SUB/INS/DEL --> count
@@ -94,37 +126,25 @@ def genVCFcons(ref_fasta, depth_file, vcf_input, prefix, newid,
     f_variant = open(prefix+'.vcfcons.variants.csv', 'w')
     variant_writer = DictWriter(f_variant, fieldnames=VARIANT_FIELDS, delimiter='\t')
     variant_writer.writeheader()
+    get_cov_and_alt = GET_COV_AND_ALT.get(vcf_type, partial(_cov_and_alt_from_counts, get_alt_count_std))
     for v in vcf_reader:
         # deepvariant has this weird record of RefCalls, ignore them
         if vcf_type == 'deepvariant' and v.FILTER == ['RefCall']: continue
+        # pull out the record fields once, pyvcf attribute access is not cheap
+        v_pos, v_qual, v_ref, v_alts = v.POS, v.QUAL, v.REF, v.ALT
+        num_gt = len(v_alts)+1
         x = v.samples[0]
         # DeepVariant is unphased, can be 0/1, 1/1, etc...
         # pbaa is ?????
         try:
-            if vcf_type == 'pbaa':
-                total_cov = x.data.DP
-                alt_count_dict = get_alt_count_pbaa(len(v.ALT)+1, x, "{0}:{1}".format(prefix, v.POS))
-                alt_index, alt_count = alt_count_dict.most_common()[0]
-            elif vcf_type == 'CLC':
-                total_cov = x.data.DP
-                alt_count_dict = get_alt_count_clc(len(v.ALT)+1, x, "{0}:{1}".format(prefix, v.POS))
-                alt_index, alt_count = alt_count_dict.most_common()[0]
-            elif vcf_type == 'bcftools':
-                ##INFO=<ID=DP4,Number=4,Type=Integer,Description="Number of high-quality ref-forward , ref-reverse, alt-forward and alt-reverse bases">
-                total_cov = v.INFO['DP']
-                alt_count = v.INFO['DP4'][2] + v.INFO['DP4'][3]
-                alt_index = 1
-            else:
-                total_cov = x.data.DP
-                alt_count_dict = get_alt_count_std(len(v.ALT)+1, x, "{0}:{1}".format(prefix, v.POS))
-                alt_index, alt_count = alt_count_dict.most_common()[0]
+            total_cov, alt_index, alt_count = get_cov_and_alt(num_gt, v, x, "{0}:{1}".format(prefix, v_pos))
         except Exception as ex:
-            print("ERROR: failed to proerly parse info at {0}:{1}. Ignore! Exception msg: {2}".format(prefix, v.POS, ex))
+            print("ERROR: failed to proerly parse info at {0}:{1}. Ignore! Exception msg: {2}".format(prefix, v_pos, ex))
             continue
 
         # alt_index is '1' for ALT0, '2' for ALT1...etc, so we have to do int(alt_index)-1 to get the genotype from v.ALT
-        _ref, _alt = str(v.REF), str(v.ALT[int(alt_index)-1])
-        if len(v.ALT)>1:
+        _ref, _alt = str(v_ref), str(v_alts[int(alt_index)-1])
+        if num_gt>2:
             print("WARNING: more than 1 alt type for {0}! Using just the ALT {1} cuz most abundant.".format(prefix, _alt))
 
         alt_freq = alt_count * 1. / total_cov
@@ -136,16 +156,16 @@ def genVCFcons(ref_fasta, depth_file, vcf_input, prefix, newid,
         else: t = 'DEL'
 
         if total_cov < min_coverage:
-            print("INFO: For {0}: Ignore variant {1}:{2}->{3} because total cov is {4}.".format(prefix, v.POS, _ref, _alt, total_cov))
+            print("INFO: For {0}: Ignore variant {1}:{2}->{3} because total cov is {4}.".format(prefix, v_pos, _ref, _alt, total_cov))
         elif alt_freq < min_alt_freq:
-            print("INFO: For {0}: Ignore variant {1}:{2}->{3} because alt freq is {4}.".format(prefix, v.POS, _ref, _alt, alt_freq))
-        elif v.QUAL is not None and v.QUAL < min_qual:
-            print("INFO: For {0}: Ignore variant {1}:{2}->{3} because qual is {4}.".format(prefix, v.POS, _ref, _alt, v.QUAL))
+            print("INFO: For {0}: Ignore variant {1}:{2}->{3} because alt freq is {4}.".format(prefix, v_pos, _ref, _alt, alt_freq))
+        elif v_qual is not None and v_qual < min_qual:
+            print("INFO: For {0}: Ignore variant {1}:{2}->{3} because qual is {4}.".format(prefix, v_pos, _ref, _alt, v_qual))
         else:
-            if v.QUAL is None:
-                print("WARNING: QUAL field is empty for {0}:{1}. Ignoring QUAL filter.".format(prefix, v.POS))
+            if v_qual is None:
+                print("WARNING: QUAL field is empty for {0}:{1}. Ignoring QUAL filter.".format(prefix, v_pos))
             vcf_writer.write_record(v)
-            variant_writer.writerow({'Pos': v.POS,
+            variant_writer.writerow({'Pos': v_pos,
                                      'Type': t,
                                      'Length': abs(delta) if t != 'SUB' else 1,
                                      'Depth': total_cov,
@@ -153,58 +173,62 @@ def genVCFcons(ref_fasta, depth_file, vcf_input, prefix, newid,
             tally_types[t] += 1
             if t=='SUB':
                 # remember there could be consecutive subs
-                for cur in range(_altlen):
-                    newseqlist[v.POS-1+cur] = str(_alt)[cur]
+                # a call written over an earlier deletion/insertion replaces it (ex: DEL then SUB inside it)
+                bases[v_pos-1:v_pos-1+_altlen] = _alt.encode()
+                present[v_pos-1:v_pos-1+_altlen] = True
+                for cur in range(_altlen): insertions.pop(v_pos-1+cur, None)
             elif t=='INS': # is insertion
-                newseqlist[v.POS-1] = str(_alt)
+                bases[v_pos-1] = ord(_alt[0])
+                present[v_pos-1] = True
+                insertions[v_pos-1] = _alt[1:].encode()
                 # in case the REF is not a single base, take care of it
                 for extra_i in range(_reflen-1):
-                    curpos = v.POS+extra_i
-                    if curpos not in newseqlist:
+                    curpos = v_pos+extra_i
+                    if curpos >= len(present) or not present[curpos]:
                         print("WARNING: {0}:{1} is already deleted! Check VCF format!".format(prefix, curpos))
                     else:
-                        del newseqlist[curpos]
+                        present[curpos] = False
             else: # is deletion of size _d
                 for i in range(abs(delta)):
-                    curpos = v.POS+_reflen-2-i
-                    if curpos not in newseqlist:
+                    curpos = v_pos+_reflen-2-i
+                    if curpos >= len(present) or not present[curpos]:
                         print("WARNING: {0}:{1} is already deleted! Check VCF format!".format(prefix, curpos))
                     else:
-                        del newseqlist[curpos]
+                        present[curpos] = False
 
     vcf_writer.close()
     f_variant.close()
 
-    f = open(output_fasta, 'w')
-    newseq = make_seq_from_list(newseqlist, 0, len(refseq))
-    f.write(">" + newid + "\n" + newseq + '\n')
+    # write header and sequence separately, so we never build a temporary copy of the full sequence
+    f = open(output_fasta, 'wb', buffering=1<<20)
+    newseq = make_seq_from_list(bases, present, insertions, 0, len(refseq))
+    f.write(">{0}\n".format(newid).encode())
+    f.write(newseq)
+    f.write(b'\n')
     f.close()
 
-    f = open(output_frag_fasta, 'w')
-    i = 0
-    j = 0  # init here, in the event that the entire sequence is 29903 "N"s, the frag.fasta file will be empty
-    while i < len(newseqlist)-1 and newseqlist[i]=='N': i += 1
-    while i < len(newseqlist)-1:
-        # i is the first position that is not N
-        j = i + 1  # j is now the second position that is not N in this segment
-        # progress j until encountering the first N again, note some positions could be deleted, so ok to skip over them
-        while j < len(newseqlist) and ((j not in newseqlist) or newseqlist[j]!='N'): j+=1
-        f.write(">{0}_frag{1}\n{2}\n".format(newid, i+1, make_seq_from_list(newseqlist, i, j)))
-        i = j + 1 # is now the second position that is N
-        # progress i until encountering the first non-N again
-        while i < len(newseqlist)-1 and ((i not in newseqlist) or newseqlist[i]=='N'): i+=1
-    if j>i: f.write(">{0}_frag{1}\n{2}\n".format(newid, i+1, make_seq_from_list(newseqlist, i, j)))
+    f = open(output_frag_fasta, 'wb', buffering=1<<20)
+    # fragments are the runs of non-N bases, deleted positions are skipped over and do not break a run
+    # if the entire sequence is 29903 "N"s, the frag.fasta file will be empty
+    kept = np.flatnonzero(present) # 0-based POS of bases that are not deleted
+    is_real = np.frombuffer(bases, dtype=np.uint8)[kept] != ord('N')
+    edges = np.diff(is_real.astype(np.int8), prepend=0, append=0)
+    run_starts, run_ends = np.flatnonzero(edges==1), np.flatnonzero(edges==-1)
+    for i, j in zip(kept[run_starts], kept[run_ends-1]+1):
+        f.write(">{0}_frag{1}\n".format(newid, i+1).encode())
+        f.write(make_seq_from_list(bases, present, insertions, i, j))
+        f.write(b'\n')
     f.close()
 
     f = open(output_info, 'w')
-    count_d = Counter(newseq.upper())
+    newseq_upper = newseq.upper()
     f.write("total,num_A,num_T,num_C,num_C,num_N,num_sub,num_ins,num_del\n")
     f.write(str(len(newseq)) + ',' + \
-            str(count_d['A']) + ',' + \
-            str(count_d['T']) + ',' + \
-            str(count_d['C']) + ',' + \
-            str(count_d['G']) + ',' + \
-            str(count_d['N']) + ',' + \
+            str(newseq_upper.count(b'A')) + ',' + \
+            str(newseq_upper.count(b'T')) + ',' + \
+            str(newseq_upper.count(b'C')) + ',' + \
+            str(newseq_upper.count(b'G')) + ',' + \
+            str(newseq_upper.count(b'N')) + ',' + \
             str(tally_types['SUB']) + ',' + \
             str(tally_types['INS']) + ',' + \
             str(tally_types['DEL']) + '\n')